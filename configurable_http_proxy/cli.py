@@ -1,14 +1,119 @@
+import atexit
 import logging
+import logging.handlers
 import os
+import queue
+import re
+import signal
 import sys
+from types import MappingProxyType
 
 import click
-from tornado.httpserver import HTTPServer
-from tornado.ioloop import IOLoop
 
+from configurable_http_proxy import __version__, handler, log
 
-from configurable_http_proxy import __version__, log
-from configurable_http_proxy.configproxy import PythonProxy
+
+def _default_ciphers(rc4):
+    # ref: https://iojs.org/api/tls.html#tls_modifying_the_default_tls_cipher_suite
+    return ":".join(
+        [
+            "ECDHE-RSA-AES128-GCM-SHA256",
+            "ECDHE-ECDSA-AES128-GCM-SHA256",
+            "ECDHE-RSA-AES256-GCM-SHA384",
+            "ECDHE-ECDSA-AES256-GCM-SHA384",
+            "DHE-RSA-AES128-GCM-SHA256",
+            "ECDHE-RSA-AES128-SHA256",
+            "DHE-RSA-AES128-SHA256",
+            "ECDHE-RSA-AES256-SHA384",
+            "DHE-RSA-AES256-SHA384",
+            "ECDHE-RSA-AES256-SHA256",
+            "DHE-RSA-AES256-SHA256",
+            "HIGH",
+            rc4,
+            "!aNULL",
+            "!eNULL",
+            "!EXPORT",
+            "!DES",
+            "!RC4",
+            "!MD5",
+            "!PSK",
+            "!SRP",
+            "!CAMELLIA",
+        ]
+    )
+
+
+_DEFAULT_CIPHERS_NO_RC4 = _default_ciphers("!RC4")
+_DEFAULT_CIPHERS_RC4 = _default_ciphers("RC4")
+
+# `key:value` with a single colon, surrounding whitespace is stripped from key and value
+_HEADER_RE = re.compile(r"^\s*([^:]*?)\s*:\s*([^:]*?)\s*$")
+
+
+def _read(path):
+    with open(path, "r") as fh:
+        return fh.read()
+
+
+def _build_ssl_options(prefix, args, ssl_ciphers, passphrase_env=None):
+    # build the ssl options for the "", "api_" or "client_" interface
+    # --ssl-dhparam and --ssl-protocol are shared as there are no interface specific options for them
+    ssl = {}
+    if args.get(f"{prefix}ssl_key"):
+        ssl["key"] = _read(args[f"{prefix}ssl_key"])
+        if passphrase_env and os.environ.get(passphrase_env):
+            ssl["passphrase"] = os.environ[passphrase_env]
+    if args.get(f"{prefix}ssl_cert"):
+        ssl["cert"] = _read(args[f"{prefix}ssl_cert"])
+    if args.get(f"{prefix}ssl_ca"):
+        ssl["ca"] = _read(args[f"{prefix}ssl_ca"])
+    if args.get("ssl_dhparam"):
+        ssl["dhparam"] = _read(args["ssl_dhparam"])
+    if args.get("ssl_protocol"):
+        ssl["secureProtocol"] = args["ssl_protocol"] + "_method"
+    ssl["ciphers"] = ssl_ciphers
+    ssl["honorCipherOrder"] = True
+    ssl["requestCert"] = args.get(f"{prefix}ssl_request_cert")
+    ssl["rejectUnauthorized"] = args.get(f"{prefix}ssl_reject_unauthorized")
+    return ssl
+
+
+def _log_in_background():
+    # write the log records to stderr in a background thread, so the ioloop never waits on it. The records
+    # are still formatted on the calling thread, by QueueHandler.prepare().
+    # Returns the function which writes the records left in the queue and stops the thread.
+    # The log format doesn't use these, so don't look them up for every record
+    logging.logThreads = False
+    logging.logProcesses = False
+    logging.logMultiprocessing = False
+
+    records = queue.Queue()
+    queue_handler = logging.handlers.QueueHandler(records)
+    listener = logging.handlers.QueueListener(records, handler, respect_handler_level=True)
+    logging.root.removeHandler(handler)
+    logging.root.addHandler(queue_handler)
+    listener.start()
+    running = [listener]
+
+    def stop():
+        # may be called twice, by main() and at exit
+        if running:
+            running.pop().stop()
+            # anything logged from now on is written directly again
+            logging.root.removeHandler(queue_handler)
+            logging.root.addHandler(handler)
+
+    atexit.register(stop)
+    return stop
+
+
+def _stop_on_sigterm(io_loop):
+    # stop the ioloop on SIGTERM instead of exiting right away, which would skip the cleanup in main()
+    try:
+        io_loop.asyncio_loop.add_signal_handler(signal.SIGTERM, io_loop.stop)
+    except NotImplementedError:
+        # e.g. on Windows
+        pass
 
 
 def print_version(ctx, param, value):
@@ -21,10 +126,10 @@ class HeaderParamType(click.ParamType):
     name = "header"
 
     def convert(self, value, param, ctx):
-        out = tuple([i.strip() for i in value.split(":")])
-        if len(out) != 2:
+        match = _HEADER_RE.match(value)
+        if not match:
             self.fail(f"A single colon was expected in custom header: {value}", param, ctx)
-        return out
+        return match.groups()
 
 
 @click.command()
@@ -140,105 +245,46 @@ class HeaderParamType(click.ParamType):
 @click.option(
     "--proxy-timeout", type=click.INT, help="Timeout (in millis) when proxy receives no response from target."
 )
-@click.option("--storage-backend", help="Define an external storage class. Defaults to in-MemoryStore.")
+@click.option(
+    "--storage-backend",
+    help=(
+        "Define an external storage class, or use one of the builtin 'memory' or 'database' backends. "
+        "Defaults to in-MemoryStore."
+    ),
+)
 def main(**args):
+    # tornado and the proxy are imported here so that `--help` and `--version` don't have to load them
+    from tornado.httpserver import HTTPServer
+    from tornado.ioloop import IOLoop
+
+    from configurable_http_proxy.configproxy import PythonProxy
+
     if args.get("log_level"):
         log.setLevel(args["log_level"])
+    stop_logging = _log_in_background()
     options = {"log": log}
 
     if args.get("ssl_ciphers"):
         ssl_ciphers = args["ssl_ciphers"]
     else:
-        rc4 = "!RC4"  # disable RC4 by default
-        if args["ssl_allow_rc4"]:
-            rc4 = "RC4"
-        # ref: https://iojs.org/api/tls.html#tls_modifying_the_default_tls_cipher_suite
-        ssl_ciphers = ":".join(
-            [
-                "ECDHE-RSA-AES128-GCM-SHA256",
-                "ECDHE-ECDSA-AES128-GCM-SHA256",
-                "ECDHE-RSA-AES256-GCM-SHA384",
-                "ECDHE-ECDSA-AES256-GCM-SHA384",
-                "DHE-RSA-AES128-GCM-SHA256",
-                "ECDHE-RSA-AES128-SHA256",
-                "DHE-RSA-AES128-SHA256",
-                "ECDHE-RSA-AES256-SHA384",
-                "DHE-RSA-AES256-SHA384",
-                "ECDHE-RSA-AES256-SHA256",
-                "DHE-RSA-AES256-SHA256",
-                "HIGH",
-                rc4,
-                "!aNULL",
-                "!eNULL",
-                "!EXPORT",
-                "!DES",
-                "!RC4",
-                "!MD5",
-                "!PSK",
-                "!SRP",
-                "!CAMELLIA",
-            ]
-        )
+        # RC4 is disabled by default
+        ssl_ciphers = _DEFAULT_CIPHERS_RC4 if args["ssl_allow_rc4"] else _DEFAULT_CIPHERS_NO_RC4
 
     # ssl options
     if args.get("ssl_key") or args.get("ssl_cert"):
         raise NotImplementedError("--ssl-* is not supported yet")
-        options["ssl"] = {}
-        if args.get("ssl_key"):
-            options["ssl"]["key"] = open(args["ssl_key"], "r").read()
-            if os.environ.get("CONFIGPROXY_SSL_KEY_PASSPHRASE"):
-                options["ssl"]["passphrase"] = os.environ["CONFIGPROXY_SSL_KEY_PASSPHRASE"]
-        if args.get("ssl_cert"):
-            options["ssl"]["cert"] = open(args["ssl_cert"], "r").read()
-        if args.get("ssl_ca"):
-            options["ssl"]["ca"] = open(args["ssl_ca"], "r").read()
-        if args.get("ssl_dhparam"):
-            options["ssl"]["dhparam"] = open(args["ssl_dhparam"], "r").read()
-        if args.get("ssl_protocol"):
-            options["ssl"]["secureProtocol"] = args["ssl_protocol"] + "_method"
-        options["ssl"]["ciphers"] = ssl_ciphers
-        options["ssl"]["honorCipherOrder"] = True
-        options["ssl"]["requestCert"] = args["ssl_request_cert"]
-        options["ssl"]["rejectUnauthorized"] = args["ssl_reject_unauthorized"]
+        options["ssl"] = _build_ssl_options("", args, ssl_ciphers, "CONFIGPROXY_SSL_KEY_PASSPHRASE")
 
     # ssl options for the API interface
     if args.get("api_ssl_key") or args.get("api_ssl_cert"):
         raise NotImplementedError("--api-ssl-* is not supported yet")
-        options["api_ssl"] = {}
-        if args.get("api_ssl_key"):
-            options["api_ssl"]["key"] = open(args["api_ssl_key"], "r").read()
-            if os.environ.get("CONFIGPROXY_API_SSL_KEY_PASSPHRASE"):
-                options["api_ssl"]["passphrase"] = os.environ["CONFIGPROXY_API_SSL_KEY_PASSPHRASE"]
-        if args.get("api_ssl_cert"):
-            options["api_ssl"]["cert"] = open(args["api_ssl_cert"], "r").read()
-        if args.get("api_ssl_ca"):
-            options["api_ssl"]["ca"] = open(args["api_ssl_ca"], "r").read()
-        if args.get("ssl_dhparam"):  # api_ssl_dhparam does not exist
-            options["api_ssl"]["dhparam"] = open(args["ssl_dhparam"], "r").read()
-        if args.get("ssl_protocol"):  # api_ssl_protocol does not exist
-            options["api_ssl"]["secureProtocol"] = args["ssl_protocol"] + "_method"
-        options["api_ssl"]["ciphers"] = ssl_ciphers
-        options["api_ssl"]["honorCipherOrder"] = True
-        options["api_ssl"]["requestCert"] = args["api_ssl_request_cert"]
-        options["api_ssl"]["rejectUnauthorized"] = args["api_ssl_reject_unauthorized"]
+        options["api_ssl"] = _build_ssl_options(
+            "api_", args, ssl_ciphers, "CONFIGPROXY_API_SSL_KEY_PASSPHRASE"
+        )
 
     if args.get("client_ssl_key") or args.get("client_ssl_cert"):
         raise NotImplementedError("--client-ssl-* is not supported yet")
-        options["client_ssl"] = {}
-        if args.get("client_ssl_key"):
-            options["client_ssl"]["key"] = open(args["client_ssl_key"], "r").read()
-        if args.get("client_ssl_cert"):
-            options["client_ssl"]["cert"] = open(args["client_ssl_cert"], "r").read()
-        if args.get("client_ssl_ca"):
-            options["client_ssl"]["ca"] = open(args["client_ssl_ca"], "r").read()
-        if args.get("ssl_dhparam"):  # api_ssl_dhparam does not exist
-            options["client_ssl"]["dhparam"] = open(args["ssl_dhparam"], "r").read()
-        if args.get("ssl_protocol"):  # api_ssl_protocol does not exist
-            options["client_ssl"]["secureProtocol"] = args["ssl_protocol"] + "_method"
-        options["client_ssl"]["ciphers"] = ssl_ciphers
-        options["client_ssl"]["honorCipherOrder"] = True
-        options["client_ssl"]["requestCert"] = args["client_ssl_request_cert"]
-        options["client_ssl"]["rejectUnauthorized"] = args["client_ssl_reject_unauthorized"]
+        options["client_ssl"] = _build_ssl_options("client_", args, ssl_ciphers)
 
     options.update(
         {
@@ -249,7 +295,7 @@ def main(**args):
             "auth_token": os.environ.get("CONFIGPROXY_AUTH_TOKEN"),
             # "redirect_port": args["redirect_port"],
             # "redirect_to": args["redirect_to"],
-            "custom_headers": dict(args["custom_header"]),
+            "custom_headers": MappingProxyType(dict(args["custom_header"])),
             "timeout": args["timeout"],
             "proxy_timeout": args["proxy_timeout"],
         }
@@ -376,9 +422,14 @@ def main(**args):
     #     });
     # }
 
+    _stop_on_sigterm(IOLoop.current())
     try:
         IOLoop.current().start()
     except Exception:
         if pid_file:  # Cleanup PID file
             log.debug(f"Removing {pid_file}")
             os.remove(pid_file)
+    finally:
+        proxy.close()
+        # atexit handlers don't run when the process is killed by a signal
+        stop_logging()
@@ -1,29 +1,55 @@
 import datetime
 import importlib
-import json
 import os
+import time
 import typing
 import urllib.parse
+from types import MappingProxyType
 
+from tornado.httpclient import AsyncHTTPClient
+from tornado.ioloop import IOLoop
+from tornado.iostream import StreamClosedError
+from tornado.simple_httpclient import SimpleAsyncHTTPClient, _HTTPConnection
 from tornado.web import Application
 
 from configurable_http_proxy import log
 from configurable_http_proxy.store import MemoryStore
 from configurable_http_proxy.trie import URLTrie
-from configurable_http_proxy.handlers import APIHandler, ProxyHandler
+from configurable_http_proxy.handlers import APIHandler, ProxyHandler, json_dumps
 
 BASE_PATH = os.path.abspath(os.path.dirname(__file__))
 
+# resolution (in seconds) of the timestamps used for last_activity
+_CLOCK_RESOLUTION = 0.01
+_last_now = [0.0, None]
+
+
+def _now():
+    # datetime.datetime.now(), only re-read from the clock once per _CLOCK_RESOLUTION
+    t = time.monotonic()
+    if t - _last_now[0] > _CLOCK_RESOLUTION:
+        _last_now[:] = [t, datetime.datetime.now()]
+    return _last_now[1]
+
+
+# storage backends resolved so far, by name. Dotted paths are imported on first use.
+_BACKEND_REGISTRY = {
+    "memory": MemoryStore,
+    "database": "configurable_http_proxy.dbstore.DatabaseStore",
+}
+
 
 def load_storage(options):
     backend = options.get("storage_backend")
     if isinstance(backend, str):
-        backend_import = backend.split(".")
-        backend_module = ".".join(backend_import[:-1])
-        backend_clsname = backend_import[-1]
-        if backend_module == "":
-            raise AssertionError(f"Unknown backend provided '{backend}'")
-        backend = getattr(importlib.import_module(backend_module), backend_clsname)
+        name = backend
+        backend = _BACKEND_REGISTRY.get(name, name)
+        if isinstance(backend, str):
+            backend_module, _, backend_clsname = backend.rpartition(".")
+            if backend_module == "":
+                raise AssertionError(f"Unknown backend provided '{backend}'")
+            backend = getattr(importlib.import_module(backend_module), backend_clsname)
+            _BACKEND_REGISTRY[name] = backend
     elif backend is None:
         backend = MemoryStore
 
@@ -31,7 +57,50 @@ def load_storage(options):
     return backend()
 
 
+def _read_error_page(error_path, code, log):
+    # return the contents of the error page to use for code, or None if there is none
+    for name in (f"{code}.html", "error.html"):
+        filename = os.path.join(error_path, name)
+        try:
+            with open(filename, "rb") as fh:
+                return fh.read()
+        except FileNotFoundError:
+            log.debug(f"No error file {filename}")
+    return None
+
+
+# NOTE: _StreamingHTTPConnection and _StreamingHTTPClient extend tornado internals (_HTTPConnection,
+#       _should_follow_redirect, _connection_class), which is why requirements/base.txt pins tornado's
+#       major version. test_streaming_http_client_internals fails if they change.
+class _StreamingHTTPConnection(_HTTPConnection):
+    def data_received(self, chunk):
+        # the awaitable returned by the streaming_callback is awaited before more of the response is read,
+        # so that a target's response is only read as fast as the client receives it
+        if self.request.streaming_callback is not None and not self._should_follow_redirect():
+            flushed = self.request.streaming_callback(chunk)
+            if flushed is not None:
+                return self._wait_for_client(flushed)
+            return None
+        return super().data_received(chunk)
+
+    async def _wait_for_client(self, flushed):
+        try:
+            await flushed
+        except StreamClosedError:
+            # the client went away, so stop reading the response. The fetch fails with the closed stream.
+            self.stream.close()
+
+
+class _StreamingHTTPClient(SimpleAsyncHTTPClient):
+    # http client applying backpressure from the streaming_callback, see _StreamingHTTPConnection
+    def _connection_class(self):
+        return _StreamingHTTPConnection
+
+
 class PythonProxy:
+    # minimum time between two last_activity updates of the same route
+    last_activity_interval = datetime.timedelta(seconds=1)
+
     def __init__(self, options=()):
         super().__init__()
         self.options = options = dict(options)
@@ -41,18 +110,29 @@ class PythonProxy:
             self.log = log
 
         self._routes = load_storage(self.options)
+        # last_activity of the routes used since the last _flush_activity(), by route
+        self._pending_activity = {}
         self.include_prefix = self.options.get("include_prefix", True)
         self.prepend_path = self.options.get("prepend_path", True)
         self.headers = self.options.get("headers")
         self.host_routing = self.options.get("host_routing", False)
         self.timeout = self.options.get("timeout")
         self.proxy_timeout = self.options.get("proxy_timeout")
-        self.custom_headers = dict(self.options.get("custom_headers") or {})
+        self.custom_headers = self.options.get("custom_headers") or {}
+        if not isinstance(self.custom_headers, MappingProxyType):
+            # read-only copy, so the caller's dict can't change the headers later on
+            self.custom_headers = MappingProxyType(dict(self.custom_headers))
         self.x_forward = self.options.get("x_forward", True)
+        # seconds to wait for more websocket messages before forwarding them (0: end of ioloop iteration)
+        self.ws_batch_delay = self.options.get("ws_batch_delay", 0)
+        # maximum number of simultaneous requests to the targets (tornado's default is 10)
+        self.max_clients = self.options.get("max_clients", 1000)
+        self._http_client = None
         self.error_target = self.options.get("error_target")
         if self.error_target and not self.error_target.endswith("/"):
             self.error_target = self.error_target + "/"  # ensure trailing slash
         self.error_path = self.options.get("error_path", os.path.join(BASE_PATH, "templates"))
+        self._error_pages = {}
 
         self.default_target = self.options.get("default_target")
         if self.default_target:
@@ -71,6 +151,30 @@ class PythonProxy:
             ]
         )
 
+    @property
+    def http_client(self) -> AsyncHTTPClient:
+        # http client shared by all requests to the targets, created on first use so that it
+        # belongs to the running ioloop
+        if self._http_client is None:
+            self._http_client = _StreamingHTTPClient(force_instance=True, max_clients=self.max_clients)
+        return self._http_client
+
+    def close(self):
+        # release the http client's connections to the targets
+        if self._http_client is not None:
+            self._http_client.close()
+            self._http_client = None
+
+    @property
+    def auth_token(self):
+        return self._auth_token
+
+    @auth_token.setter
+    def auth_token(self, value):
+        # also kept as bytes, which is what the API handlers compare against
+        self._auth_token = value
+        self.auth_token_bytes = value.encode() if value else None
+
     def add_route(self, path, data):
         # add a route to the routing table
         path = self._routes.clean_path(path)
@@ -78,29 +182,41 @@ class PythonProxy:
             data["host"] = path.split("/")[1]
         self.log.info(f"Adding route {path} -> {data.get('target')}")
 
+        # any last_activity sent by the client is replaced, like every later activity update does
+        data["last_activity"] = _now()
         self._routes.add(path, data)
-        self.update_last_activity(path)
         self.log.info(f"Route added {path} -> {data.get('target')}")
 
     def remove_route(self, path) -> typing.Union[URLTrie, None]:
-        # remove a route from the routing table
-        result = self._routes.get(path)
-        if result:
-            self.log.info(f"Removing route {path}")
-            return self._routes.remove(path)
+        # remove a route from the routing table, returning the removed route (None if there was none).
+        # The route is looked up first, as storages don't have to return it from remove().
+        route = self._routes.get(path)
+        if route:
+            self._routes.remove(path)
+            self.log.info(f"Removed route {path}")
+        return route
 
     def get_route(self, path: str):
         # GET a single route
+        self._flush_activity()
         path = self._routes.clean_path(path)
         return self._routes.get(path)
 
     def get_routes(self, inactive_since=None):
         # GET all of routes
-        routes = self._routes.get_all()
-        if inactive_since:
-            return {path: val for path, val in routes.items() if val["last_activity"] < inactive_since}
-        else:
-            return routes
+        self._flush_activity()
+        if not inactive_since:
+            return self._routes.get_all()
+        # the storage filters the routes, e.g. in the database query
+        return self._routes.get_inactive_since(inactive_since)
+
+    def get_routes_json(self, inactive_since=None) -> bytes:
+        # GET all of routes, serialized as JSON
+        if not inactive_since and hasattr(self._routes, "get_all_serialized"):
+            # the whole routing table is requested, which the storage can cache
+            self._flush_activity()
+            return self._routes.get_all_serialized(json_dumps)
+        return json_dumps(self.get_routes(inactive_since))
 
     def target_for_req(self, host, path):
         # return proxy target for a given url path
@@ -114,13 +230,35 @@ class PythonProxy:
                 "target": route.data["target"],
             }
 
+    async def get_error_page(self, code):
+        # return the contents of the error page in error_path for code, or None if there is none.
+        # Error pages are static, so they are read from disk only once.
+        cache_key = (self.error_path, code)
+        if cache_key not in self._error_pages:
+            self._error_pages[cache_key] = await IOLoop.current().run_in_executor(
+                None, _read_error_page, self.error_path, code, self.log
+            )
+        return self._error_pages[cache_key]
+
     def update_last_activity(self, prefix):
+        # called for every proxied request and websocket message, so the time is only recorded here.
+        # The store is updated by _flush_activity() at most last_activity_interval later.
+        if not self._pending_activity:
+            IOLoop.current().call_later(self.last_activity_interval.total_seconds(), self._flush_activity)
+        self._pending_activity[prefix] = _now()
+
+    def _flush_activity(self):
+        # write the recorded last_activity of the routes to the store
+        pending, self._pending_activity = self._pending_activity, {}
+        for prefix, now in pending.items():
+            self._write_last_activity(prefix, now)
+
+    def _write_last_activity(self, prefix, now):
         result = self._routes.get(prefix)
         if result:
-            return self._routes.update(prefix, {"last_activity": datetime.datetime.now()})
-
-    def handle_health_check(self, req, res):
-        if req.url == "/_chp_healthz":
-            res.writeHead(200, {"Content-Type": "application/json"})
-            res.write(json.dumps({"status": "OK"}))
-            res.end()
+            last_activity = result.get("last_activity")
+            if isinstance(last_activity, datetime.datetime) and last_activity.tzinfo is None:
+                # busy routes (e.g. websockets) are only updated once per last_activity_interval
+                if now - last_activity < self.last_activity_interval:
+                    return
+            return self._routes.update(prefix, {"last_activity": now})
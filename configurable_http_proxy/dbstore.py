@@ -1,9 +1,12 @@
+import functools
 import json
 import logging
 import os
+import time
 from datetime import datetime
 
 from dataset import connect
+from sqlalchemy import event, func
 
 from configurable_http_proxy.store import BaseStore
 
@@ -34,6 +37,10 @@ class DatabaseStore(BaseStore):
 
     default_db_url = "sqlite:///chp.sqlite"
     default_db_table = "chp_routes"
+    # get_target() results are cached for a short time to avoid a query for every proxied request.
+    # Changes made by other chp instances sharing the database are visible after at most this delay.
+    target_cache_ttl = 5.0
+    target_cache_size = 1024
 
     def __init__(self):
         super().__init__()
@@ -41,6 +48,7 @@ class DatabaseStore(BaseStore):
         db_url = os.environ.get("CHP_DATABASE_URL", self.default_db_url)
         db_table = os.environ.get("CHP_DATABASE_TABLE", self.default_db_table)
         self.routes: TableTrie = TableTrie(db_url, table=db_table)
+        self._target_cache = {}
         log.info("Using DatabaseStore as the storage backend")
         log.debug(f"DataBaseStore database url is {db_url}")
         for route, data in self.get_all().items():
@@ -49,25 +57,40 @@ class DatabaseStore(BaseStore):
     def clean(self):
         # remove all information stored so far
         self.routes.clean()
+        self._target_cache.clear()
 
     def get_target(self, path: str):
         # return the data for the most specific matching route
-        return self.routes.get(self.clean_path(path), trie=True)
+        path = self.clean_path(path)
+        now = time.monotonic()
+        cached = self._target_cache.get(path)
+        if cached and cached[0] > now:
+            return cached[1]
+        route = self.routes.get(path, trie=True)
+        if len(self._target_cache) >= self.target_cache_size:
+            self._target_cache.clear()
+        self._target_cache[path] = (now + self.target_cache_ttl, route)
+        return route
 
     def get_all(self):
         # return all routes as route => data
         return self.routes.all()
 
+    def get_inactive_since(self, inactive_since):
+        # return all routes with a last_activity before inactive_since as route => data
+        return self.routes.inactive_since(inactive_since)
+
     def add(self, path: str, data):
-        # add a new route /path, storing data
-        if self.get(path):
-            self.update(path, data)
-        else:
-            self.routes.add(path, data)
+        # add a new route /path, storing data (merged into an existing route)
+        self.routes.upsert(self.clean_path(path), data)
+        self._target_cache.clear()
 
     def update(self, path: str, data):
         # update an existing route
         self.routes.update(self.clean_path(path), data)
+        if data.keys() - {"last_activity"}:
+            # the activity updates, made for every proxied request, don't change the routing
+            self._target_cache.clear()
 
     def remove(self, path: str):
         # remove an existing route
@@ -75,6 +98,7 @@ class DatabaseStore(BaseStore):
         route = self.routes.get(path)
         if route:
             self.routes.remove(path)
+            self._target_cache.clear()
         return route
 
     def get(self, path):
@@ -82,6 +106,40 @@ class DatabaseStore(BaseStore):
         return self.routes.get(self.clean_path(path))
 
 
+@functools.singledispatch
+def _json_default(val):
+    # converter for values the json module cannot serialize, dispatched on type
+    raise TypeError(f"Object of type {type(val).__name__} is not JSON serializable")
+
+
+@_json_default.register(datetime)
+def _json_default_datetime(val):
+    # datetimes are stored as tagged strings, e.g. "_dt_:2020-01-01T00:00:00"
+    return f"_dt_:{val.isoformat()}"
+
+
+def _json_object_hook(obj):
+    # restore the datetimes tagged by _json_default
+    for k, v in obj.items():
+        if isinstance(v, str) and v.startswith("_dt_:"):
+            obj[k] = datetime.fromisoformat(v[len("_dt_:") :])
+    return obj
+
+
+@functools.lru_cache(maxsize=1024)
+def _split_routes(path):
+    # reverse tree of routes, always ending with the top level route
+    # e.g. /path/to/document
+    # => (/path/to/document, /path/to, /path, /)
+    if path == "/" or path == "":
+        return ("/",)
+    levels = path.split("/")
+    routes = tuple("/".join(levels[:i]) for i in range(len(levels), 1, -1))
+    if routes[-1:] != ("/",):
+        routes += ("/",)
+    return routes
+
+
 class TableTrie:
     """A URLtrie-like backed by a database
 
@@ -96,18 +154,14 @@ class TableTrie:
         routes.add('/foo/bar', {'some': 'value'})
 
         # query a mapping that exists
-        routes.get('/foo/bar/baz')
-        => {
-          'prefix': '/foo/bar',
-          'some': 'value'
-        }
+        route = routes.get('/foo/bar/baz', trie=True)
+        route.prefix => '/foo/bar'
+        route.data => {'some': 'value'}
 
         # query a mapping that does not exist
-        routes.get('/fox/bax')
-        => {
-          'prefix': '/',
-          'some': 'default'
-        }
+        route = routes.get('/fox/bax', trie=True)
+        route.prefix => '/'
+        route.data => {'some': 'default'}
 
     How values are stored:
 
@@ -133,86 +187,107 @@ class TableTrie:
     def __init__(self, url, table=None):
         table = table or "chp_routes"
         self.db = connect(url)
+        if self.db.engine.dialect.name == "sqlite":
+            event.listen(self.db.engine, "connect", _sqlite_on_connect)
         self.table = self.db[table]
         self.table.create_column("path", self.db.types.string(length=128), unique=True)
+        self.table.create_column("data", self.db.types.text)
+        # bind the table methods and columns once, they are used for every request
+        self._find = self.table.find
+        self._find_one = self.table.find_one
+        self._insert = self.table.insert
+        self._update = self.table.update
+        self._upsert = self.table.upsert
+        self._delete = self.table.delete
+        self._data_column = self.table.table.c.data
 
     def get(self, path, trie=False):
         # return the data store for path
         # -- if trie is False (default), will return data for the exact path
         # -- if trie is True, will return the data and the matching prefix
-        try_routes = self._split_routes(path) if trie else [path]
-        for path in try_routes:
-            doc = self.table.find_one(path=path, order_by="id")
+        if not trie:
+            doc = self._find_one(path=path)
+            return (self._from_json(doc["data"]) or None) if doc else None
+
+        # fetch all candidate prefixes in a single query, then pick the most specific one
+        try_routes = _split_routes(path)
+        docs = {doc["path"]: doc for doc in self._find(path={"in": try_routes})}
+        for prefix in try_routes:
+            doc = docs.get(prefix)
             if doc:
-                if not trie:
-                    data = self._from_json(doc["data"])
-                else:
-                    data = doc
-                    data["data"] = self._from_json(doc["data"])
-                    data["prefix"] = path
-                break
-        else:
-            data = None
-        return attrdict(data) if data else None
+                return _Route(doc["id"], doc["path"], prefix, self._from_json(doc["data"]))
+        return None
 
     def add(self, path, data):
         # add the data for the given exact path
-        self.table.insert({"path": path, "data": self._to_json(data)})
+        self._insert({"path": path, "data": self._to_json(data)})
 
     def update(self, path, data):
         # update the data for the given exact path
-        doc = self.table.find_one(path=path, order_by="id")
+        doc = self._find_one(path=path)
         doc["data"] = self._from_json(doc["data"])
         doc["data"].update(data)
         doc["data"] = self._to_json(doc["data"])
-        self.table.update(doc, "id")
+        self._update(doc, "id")
+
+    def upsert(self, path, data):
+        # add the data for the given exact path, or update it if the path exists
+        doc = self._find_one(path=path)
+        if doc:
+            doc_data = self._from_json(doc["data"])
+            doc_data.update(data)
+            data = doc_data
+        self._upsert({"path": path, "data": self._to_json(data)}, ["path"])
 
     def remove(self, path):
         # remove all matching routes for the given path, except default route
-        for subpath in self._split_routes(path):
+        for subpath in _split_routes(path):
             if subpath == "/" and path != "/":
                 continue
-            self.table.delete(path=subpath)
+            self._delete(path=subpath)
 
     def all(self):
         # return all data for all paths
-        return {item["path"]: self._from_json(item["data"]) for item in self.table.find(order_by="id")}
+        return {item["path"]: self._from_json(item["data"]) for item in self._find(order_by="id")}
+
+    def inactive_since(self, inactive_since):
+        # return all data for paths with a last_activity before inactive_since
+        if self.db.engine.dialect.name != "sqlite":
+            # the JSON functions differ across dialects, filter in python instead
+            return {
+                path: data
+                for path, data in self.all().items()
+                if data.get("last_activity") and data["last_activity"] < inactive_since
+            }
+        # last_activity is stored as a tagged ISO 8601 string, which sorts chronologically
+        last_activity = func.json_extract(self._data_column, "$.last_activity")
+        items = self._find(last_activity < _json_default(inactive_since), order_by="id")
+        return {item["path"]: self._from_json(item["data"]) for item in items}
 
     def _to_json(self, data):
         # simple converter for serializable data
-        for k, v in dict(data).items():
-            if isinstance(v, datetime):
-                data[k] = f"_dt_:{v.isoformat()}"
-            elif isinstance(v, dict):
-                data[k] = self._to_json(v)
-        return json.dumps(data)
+        return json.dumps(data, default=_json_default)
 
     def _from_json(self, data):
         # simple converter from serialized data
-        data = json.loads(data) if isinstance(data, (str, bytes)) else data
-        for k, v in dict(data).items():
-            if isinstance(v, str) and v.startswith("_dt_:"):
-                data[k] = datetime.fromisoformat(v.split(":", 1)[-1])
-            elif isinstance(v, dict):
-                data[k] = self._from_json(v)
-        return data
-
-    def _split_routes(self, path):
-        # generator for reverse tree of routes
-        # e.g. /path/to/document
-        # => yields /path/to/document, /path/to, /path, /
-        levels = path.split("/")
-        for i, e in enumerate(levels):
-            yield "/".join(levels[: len(levels) - i + 1])
-        # always yield top level route
-        yield "/"
+        return json.loads(data, object_hook=_json_object_hook) if isinstance(data, (str, bytes)) else data
 
     def clean(self):
-        self.table.delete()
+        self._delete()
+
+
+def _sqlite_on_connect(dbapi_connection, connection_record):
+    # dataset already enables WAL journaling for sqlite files, with which the NORMAL synchronous mode
+    # can't corrupt the database and needs far fewer fsyncs for every route change
+    dbapi_connection.execute("PRAGMA synchronous=NORMAL")
+
 
+class _Route:
+    # the matching route returned by TableTrie.get(trie=True), similar to a URLTrie node
+    __slots__ = ("id", "path", "prefix", "data")
 
-class attrdict(dict):
-    # enable .attribute for dicts
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-        self.__dict__ = self
+    def __init__(self, id, path, prefix, data):
+        self.id = id
+        self.path = path
+        self.prefix = prefix
+        self.data = data
@@ -1,19 +1,46 @@
+import contextlib
 import datetime
+import functools
+import hmac
 import json
-import os
+import logging
 import re
+import socket
 import typing
 import urllib.parse
 
 import dateutil.parser
+from tornado import httputil
 from tornado.gen import with_timeout
-from tornado.httpclient import AsyncHTTPClient, HTTPRequest, HTTPClientError
+from tornado.httpclient import HTTPRequest, HTTPClientError
+from tornado.ioloop import IOLoop
 from tornado.web import RequestHandler, HTTPError
 from tornado.websocket import WebSocketHandler, websocket_connect
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 if typing.TYPE_CHECKING:
     from configurable_http_proxy.configproxy import PythonProxy
 
+# headers of the target's response which are not passed on to the client, in the canonical case
+# tornado's HTTPHeaders uses for header names
+_HOP_BY_HOP_HEADERS = frozenset(("Content-Length", "Transfer-Encoding", "Content-Encoding", "Connection"))
+
+# bytes of a target's response buffered before it is streamed to the client. Smaller responses are
+# sent in one piece with a Content-Length.
+_STREAM_BUFFER_SIZE = 64 * 1024
+
+_TCP_CORK = getattr(socket, "TCP_CORK", None)
+
+# port at the end of a Host header, e.g. "example.com:8000"
+_HOST_PORT_RE = re.compile(r":([0-9]+)$")
+
+# paths made only of these characters are left unchanged by urllib.parse.quote
+_SAFE_PATH_RE = re.compile(r"[A-Za-z0-9\-._~/]*")
+
 
 def json_converter(val):
     if isinstance(val, (datetime.datetime, datetime.date)):
@@ -21,6 +48,83 @@ def json_converter(val):
     raise TypeError(f"Object of type {type(val).__name__} is not JSON serializable")
 
 
+def _json_dumps(val):
+    return json.dumps(val, default=json_converter).encode()
+
+
+# json_dumps returns bytes, which tornado writes as is instead of encoding them
+if orjson is not None:
+    # orjson serializes datetimes natively
+
+    def json_dumps(val):
+        try:
+            data = orjson.dumps(val, default=json_converter)
+        except TypeError:
+            # e.g. integers beyond 64 bits, which only the json module serializes
+            return _json_dumps(val)
+        if b"null" in data:
+            # orjson writes infinity and NaN as null, the json module as Infinity and NaN. The rare values
+            # with a null are serialized by the json module, so that the output doesn't depend on orjson.
+            return _json_dumps(val)
+        return data
+
+else:
+    json_dumps = _json_dumps
+
+# request bodies are always parsed by the json module: orjson turns big integers into floats, and rejects
+# numbers such as 1e400
+json_loads = json.loads
+
+_HEALTH_CHECK_BODY = json_dumps({"status": "OK"})
+
+
+def _parse_isodate(value):
+    # the stdlib parser is much faster and handles the common cases, dateutil handles the rest of ISO8601
+    try:
+        return datetime.datetime.fromisoformat(value.replace("Z", "+00:00"))
+    except ValueError:
+        return dateutil.parser.isoparse(value)
+
+
+@functools.lru_cache(maxsize=1024)
+def _split_target(target):
+    # route targets rarely change, so only parse them once
+    return urllib.parse.urlsplit(target)
+
+
+def _quote(path):
+    # urllib.parse.quote(path), skipped for the common case of a path that needs no quoting
+    if _SAFE_PATH_RE.fullmatch(path):
+        return path
+    return urllib.parse.quote(path)
+
+
+@functools.lru_cache(maxsize=1024)
+def _quote_prefix(prefix):
+    # route prefixes are the same for every request to a route, so only quote them once
+    return _quote(prefix)
+
+
+def _set_cork(sock, value):
+    try:
+        sock.setsockopt(socket.IPPROTO_TCP, _TCP_CORK, value)
+    except OSError:  # e.g. not a TCP socket, or it was closed in the meantime
+        pass
+
+
+@contextlib.contextmanager
+def _corked(stream, cork=True):
+    # hold back partial TCP packets while several messages are written to the stream (linux only)
+    sock = stream.socket if cork and stream and _TCP_CORK is not None else None
+    if sock is not None:
+        _set_cork(sock, 1)
+    try:
+        yield
+    finally:
+        if sock is not None:
+            _set_cork(sock, 0)
+
+
 async def apply_timeout(timeout, future):
     if timeout is None:
         return await future
@@ -58,10 +162,15 @@ class APIHandler(RequestHandler):
             return
 
         auth = self.request.headers.get("authorization", "")
-        auth = auth.strip()
-        if auth and auth.startswith("token") and self.proxy.auth_token == auth[len("token") :].strip():
+        # "token <auth_token>", split on the first run of whitespace
+        parts = auth.split(None, 1)
+        if (
+            len(parts) == 2
+            and parts[0].lower() == "token"
+            and hmac.compare_digest(self.proxy.auth_token_bytes, parts[1].rstrip().encode())
+        ):
             return
-        self.proxy.log.debug(f"Rejecting API request from: {auth or 'no authorization'}")
+        self.proxy.log.debug("Rejecting API request from: %s", auth or "no authorization")
         raise HTTPError(403)
 
     def get(self, path: str = None):
@@ -74,8 +183,7 @@ class APIHandler(RequestHandler):
             else:
                 self.set_status(200)
                 self.set_header("Content-Type", "application/json")
-                self.write(json.dumps(route, default=json_converter))
-                self.finish()
+                self.finish(json_dumps(route))
                 return
 
         # GET returns routing table as JSON dict
@@ -84,25 +192,26 @@ class APIHandler(RequestHandler):
         )
         if inactive_since:
             try:
-                inactive_since = dateutil.parser.isoparse(inactive_since)
+                inactive_since = _parse_isodate(inactive_since)
             except ValueError:
                 raise HTTPError(400, f"Invalid datestamp '{inactive_since}' must be ISO8601.")
 
-        routes = self.proxy.get_routes(inactive_since)
-
         self.set_status(200)
         self.set_header("Content-Type", "application/json")
-        self.write(json.dumps(routes, default=json_converter))
-        self.finish()
+        self.finish(self.proxy.get_routes_json(inactive_since))
 
     def post(self, path: str = None):
         self.is_authorized()
         # POST adds a new route
         path = path or "/"
-        data = json.loads(self.request.body)
+        try:
+            data = json_loads(self.request.body)
+        except ValueError:
+            raise HTTPError(400, "Request body must be JSON")
 
-        if not isinstance(data.get("target"), str):
-            self.proxy.log.warn(f"Bad POST data: {json.dumps(data, default=json_converter)}")
+        if not isinstance(data, dict) or not isinstance(data.get("target"), str):
+            if self.proxy.log.isEnabledFor(logging.WARNING):
+                self.proxy.log.warning("Bad POST data: %s", json.dumps(data, default=json_converter))
             raise HTTPError(400, "Must specify 'target' as string")
 
         self.proxy.add_route(path, data)
@@ -113,12 +222,8 @@ class APIHandler(RequestHandler):
         self.is_authorized()
 
         # DELETE removes an existing route
-        result = self.proxy.get_route(path)
-        if result:
-            self.proxy.remove_route(path)
-            self.set_status(204)
-        else:
-            self.set_status(404)
+        removed = self.proxy.remove_route(path)
+        self.set_status(204 if removed else 404)
         self.finish()
 
 
@@ -129,6 +234,10 @@ class ProxyHandler(WebSocketHandler):
         self.target = None
         self.ws_client = None
         self.closed = True
+        self._client_messages = []
+        self._target_messages = []
+        self._target_headers = None
+        self._buffered = 0
 
     def write_error(self, status_code, **kwargs):
         err_type, err, err_tb = (None, None, None)
@@ -154,7 +263,7 @@ class ProxyHandler(WebSocketHandler):
             return
 
         if self.proxy.error_target:
-            error_target = urllib.parse.urlparse(self.proxy.error_target)
+            error_target = _split_target(self.proxy.error_target)
             # error request is $errorTarget/$code?url=$requestUrl
             error_target = error_target._replace(
                 query=f"url={urllib.parse.quote(self.request.path)}",
@@ -169,37 +278,32 @@ class ProxyHandler(WebSocketHandler):
             #     target.ca = this.options.clientSsl.ca;
             # }
 
-            http_client = AsyncHTTPClient()
             try:
-                response = await http_client.fetch(error_target.geturl(), raise_error=True, method="GET")
+                response = await self.proxy.http_client.fetch(
+                    error_target.geturl(), raise_error=True, method="GET"
+                )
             except Exception as err2:
                 self.proxy.log.error(f"Failed to get custom error page: {err2}")
                 self.handle_proxy_error_default(code, err)
                 return
 
             # Return the error we got from the target
-            for key, val in response.headers.get_all():
-                self.set_header(key, val)
+            self._copy_response_headers(response.headers)
             self.set_status(code)
             self.write(response.body)
             self.finish()
 
         elif self.proxy.error_path:
-            filename = os.path.join(self.proxy.error_path, f"{code}.html")
-            if not os.path.exists(filename):
-                self.proxy.log.debug(f"No error file {filename}")
-                filename = os.path.join(self.proxy.error_path, "error.html")
-                if not os.path.exists(filename):
-                    self.proxy.log.debug(f"No error file {filename}")
-                    self.handle_proxy_error_default(code, err)
-                    return
             try:
-                with open(filename, "r") as fh:
-                    self.write(fh.read())
+                body = await self.proxy.get_error_page(code)
             except OSError as err2:
-                self.proxy.log.error(f"Error reading {filename} {err2}")
+                self.proxy.log.error(f"Error reading error page for {code} {err2}")
                 self.handle_proxy_error_default(code, err)
                 return
+            if body is None:
+                self.handle_proxy_error_default(code, err)
+                return
+            self.write(body)
             self.set_status(code)
             self.set_header("Content-Type", "text/html")
             self.finish()
@@ -216,21 +320,23 @@ class ProxyHandler(WebSocketHandler):
         prefix, target = self.target["prefix"], self.target["target"]
         self.proxy.log.debug(f"PROXY WEB {self.request.path} to {target}")
 
-        proxy_path = urllib.parse.quote(path)
+        proxy_path = _quote(path)
         if not self.proxy.include_prefix:
-            proxy_path = proxy_path[len(urllib.parse.quote(prefix)) :]
+            proxy_path = proxy_path[len(_quote_prefix(prefix)) :]
 
-        target = urllib.parse.urlparse(target)
+        target = _split_target(target)
         if self.proxy.prepend_path:
-            query_strings = [target.query, self.request.query]
-            query_strings = [i for i in query_strings if i not in (None, "")]
-            target = target._replace(query="&".join(query_strings))
-            target = target._replace(path=target.path.rstrip("/") + "/" + proxy_path.lstrip("/"))
+            query = "&".join(i for i in (target.query, self.request.query) if i)
+            path = target.path.rstrip("/") + "/" + proxy_path.lstrip("/")
         else:
-            target = target._replace(query=self.request.query)
-            target = target._replace(path=proxy_path)
+            query = self.request.query
+            path = proxy_path
+
+        return urllib.parse.urlunsplit((target.scheme, target.netloc, path, query, target.fragment))
 
-        return target.geturl()
+    def compute_etag(self):
+        # responses are passed on as the target sent them, so don't hash every body to add an Etag
+        return None
 
     def on_finish(self):
         # update last activity on completion of the request only consider 'successful' requests activity
@@ -250,39 +356,39 @@ class ProxyHandler(WebSocketHandler):
         if self.request.path == "/_chp_healthz":
             self.set_status(200)
             self.set_header("Content-Type", "application/json")
-            self.write(json.dumps({"status": "OK"}))
-            self.finish()
+            self.finish(_HEALTH_CHECK_BODY)
             return True
         return False
 
-    def _get_proxy_request(self, url):
-        # Add custom-headers if required
-        headers = dict(self.request.headers.get_all())
-        headers.update(self.proxy.custom_headers)
+    def _get_proxy_request(self, url, **kwargs):
+        # The request headers are copied as HTTPHeaders, never through a dict, because the http client
+        # adds its own headers to them. Add custom-headers if required
+        headers = self.request.headers.copy()
+        if self.proxy.custom_headers:
+            headers.update(self.proxy.custom_headers)
 
         # Add x-forward headers if required
         if self.proxy.x_forward:
-            encrypted = self.request.uri.partition(":")[0] in {"https", "wss"}
+            encrypted = self.request.protocol == "https"
             host = headers.get("host")
             port = None
             if host:
-                port = re.match(".*?:([0-9]+)$", host)
+                port = _HOST_PORT_RE.search(host)
                 if port:
                     port = int(port.group(1))
             if port is None:  # Detect the port based on default ports fo scheme
-                port = 433 if encrypted else 80
-
-            fwd_values = {
-                "for": self.request.remote_ip,
-                "port": str(port),
-                "proto": "https" if encrypted else "http",
-            }
+                port = 443 if encrypted else 80
 
-            for key in ["for", "port", "proto"]:
-                key_header = f"x-forwarded-{key}"
-                headers[key_header] = ",".join([headers.get(key_header, ""), fwd_values[key]])
+            fwd_values = (
+                ("X-Forwarded-For", self.request.remote_ip),
+                ("X-Forwarded-Port", str(port)),
+                ("X-Forwarded-Proto", "https" if encrypted else "http"),
+            )
+            for key, value in fwd_values:
+                existing = headers.get(key)
+                headers[key] = f"{existing},{value}" if existing else value
 
-            headers["x-forwarded-host"] = headers.get("x-forwarded-host") or headers.get("host") or ""
+            headers["X-Forwarded-Host"] = headers.get("x-forwarded-host") or host or ""
 
         return HTTPRequest(
             url,
@@ -292,38 +398,72 @@ class ProxyHandler(WebSocketHandler):
             follow_redirects=False,
             allow_nonstandard_methods=True,  # Needed to allow body for GET, OPTIONS, DELETE
             request_timeout=self.proxy.proxy_timeout,
+            **kwargs,
         )
 
+    def _copy_response_headers(self, target_headers):
+        # NOTE: Is there a better way to handle this part ? We are currently using the private _headers
+        #       In tornado 6 - This is Server, Content-Type, Date
+        #       The upstream headers were already validated when tornado parsed the response, so they are
+        #       added directly instead of through set_header() / add_header()
+        #       Both are HTTPHeaders, whose names are already normalized, so they are compared as is
+        headers = self._headers
+        existing_headers = set(headers)
+        for key, val in target_headers.get_all():
+            if key in _HOP_BY_HOP_HEADERS:
+                # Ignore these headers
+                continue
+            if key in existing_headers:  # Replace existing values from the proxy server
+                headers[key] = val
+            else:
+                headers.add(key, val)
+
     async def call_proxy(self, path=None):
         url = await self.get_target_url(path)
         if url is None:
             return
 
-        req = self._get_proxy_request(url)
-        http_client = AsyncHTTPClient()
+        # the response is passed on while it is received, see _on_target_header() and _on_target_chunk()
+        req = self._get_proxy_request(
+            url, header_callback=self._on_target_header, streaming_callback=self._on_target_chunk
+        )
         try:
-            response = await http_client.fetch(req, raise_error=False)
+            await self.proxy.http_client.fetch(req, raise_error=False)
         except Exception as err:
+            if self._headers_written:
+                # part of the response was sent already, closing the connection tells the client it failed
+                self.proxy.log.error(f"503 {self.request.method} {self.request.path} {err}")
+                self.request.connection.close()
+                return
+            self.clear()
             await self.handle_proxy_error(503, err)
             return
 
-        self.set_status(response.code)
-        # NOTE: Is there a better way to handle this part ? We are currently using the private _headers
-        #       In tornado 6 - This is Server, Content-Type, Date
-        existing_headers = {h[0].lower() for h in self._headers.get_all()}
-        for key, val in response.headers.get_all():
-            if key.lower() in ("content-length", "transfer-encoding", "content-encoding", "connection"):
-                # Ignore these headers
-                continue
-            if key.lower() in existing_headers:  # Replace existing values from the proxy server
-                self.set_header(key, val)
-            else:
-                self.add_header(key, val)
-        if response.body:
-            self.write(response.body)
-            self.set_header("Content-Length", len(response.body))
+        # finish() sets the Content-Length if the whole body is still buffered
         self.finish()
 
+    def _on_target_header(self, line):
+        # called with the status line of the target's response, each header line, and then "\r\n"
+        if line.startswith("HTTP/"):
+            start_line = httputil.parse_response_start_line(line.rstrip("\r\n"))
+            self.set_status(start_line.code, start_line.reason)
+            self._target_headers = httputil.HTTPHeaders()
+        elif line == "\r\n":
+            self._copy_response_headers(self._target_headers)
+        else:
+            self._target_headers.parse_line(line)
+
+    def _on_target_chunk(self, chunk):
+        # called with each part of the target's response body, which is streamed to the client once
+        # more than _STREAM_BUFFER_SIZE bytes are buffered. The http client waits for the returned flush
+        # before reading more of the response, so a slow client doesn't make it pile up in memory.
+        self.write(chunk)
+        self._buffered += len(chunk)
+        if self._buffered >= _STREAM_BUFFER_SIZE:
+            self._buffered = 0
+            return self.flush()
+        return None
+
     async def get(self, path=None):
         if self.request.headers.get("Upgrade", "").lower() == "websocket":
             url = await self.get_target_url(path)
@@ -333,7 +473,7 @@ class ProxyHandler(WebSocketHandler):
             #       cause if the websocket cannot connect - we want to throw an error
             #       Maybe we should do this in get_websocket_protocol() instead as that runs after
             #       the header level checks
-            await self.start_ws_client(path)
+            await self.start_ws_client(url)
             if not self.ws_client:
                 # Creating the websocket client to our target failed - so, don't establish a websocket connection
                 return
@@ -342,14 +482,12 @@ class ProxyHandler(WebSocketHandler):
                 await WebSocketHandler.get(self, path)
             except Exception:
                 # Cleanup dangling ws-client connection if we are not upgrading to a websocket
-                self.ws_client.close()
-                self.ws_client = None
+                self._close_ws_client()
                 raise
 
             if self.get_status() != 101:
                 # Cleanup dangling ws-client connection if we are not upgrading to a websocket
-                self.ws_client.close()
-                self.ws_client = None
+                self._close_ws_client()
 
         elif self.health_check():
             pass
@@ -367,12 +505,10 @@ class ProxyHandler(WebSocketHandler):
     put = _proxy_method
     options = _proxy_method
 
-    async def start_ws_client(self, path=None):
+    async def start_ws_client(self, url):
+        # url is the target url resolved by get_target_url()
         self.closed = False
 
-        url = await self.get_target_url(path)
-        if url is None:
-            return
         url = urllib.parse.urlparse(url)
         url = url._replace(scheme=url.scheme.replace("http", "ws"))
         url = url.geturl()
@@ -380,8 +516,7 @@ class ProxyHandler(WebSocketHandler):
         def write(msg):
             if self.closed:
                 if self.ws_client:
-                    self.ws_client.close()
-                    self.ws_client = None
+                    self._close_ws_client()
             else:
                 # update timestamp on any reply data
                 prefix = self.target["prefix"] if self.target else ""
@@ -389,7 +524,7 @@ class ProxyHandler(WebSocketHandler):
                     self.proxy.update_last_activity(prefix)
 
                 if self.ws_client and msg is not None:
-                    self.write_message(msg, binary=isinstance(msg, bytes))
+                    self._queue_ws_message(self._target_messages, self._flush_target_messages, msg)
 
         req = self._get_proxy_request(url)
         try:
@@ -411,10 +546,45 @@ class ProxyHandler(WebSocketHandler):
             if prefix:
                 self.proxy.update_last_activity(prefix)
 
-            self.ws_client.write_message(message)
+            self._queue_ws_message(self._client_messages, self._flush_client_messages, message)
+
+    def _queue_ws_message(self, queue, flush, message):
+        # messages are forwarded in batches, at the end of the current ioloop iteration or after
+        # proxy.ws_batch_delay seconds. This lets bursts of small messages share TCP packets.
+        queue.append(message)
+        if len(queue) == 1:
+            if self.proxy.ws_batch_delay:
+                IOLoop.current().call_later(self.proxy.ws_batch_delay, flush)
+            else:
+                IOLoop.current().add_callback(flush)
+
+    def _flush_client_messages(self):
+        # forward the messages from the client to the target
+        messages, self._client_messages = self._client_messages, []
+        if not self.ws_client:
+            return
+        with _corked(self.ws_client.protocol.stream, len(messages) > 1):
+            for message in messages:
+                self.ws_client.write_message(message, binary=isinstance(message, bytes))
+
+    def _flush_target_messages(self):
+        # forward the messages from the target to the client
+        messages, self._target_messages = self._target_messages, []
+        if not self.ws_connection or self.ws_connection.is_closing():
+            return
+        with _corked(self.ws_connection.stream, len(messages) > 1):
+            for message in messages:
+                self.write_message(message, binary=isinstance(message, bytes))
+
+    def _close_ws_client(self):
+        # forward the client's messages still waiting for their batch first, the target must get them
+        # all before the connection is closed
+        if self._client_messages:
+            self._flush_client_messages()
+        self.ws_client.close()
+        self.ws_client = None
 
     def on_close(self):
         if self.ws_client:
-            self.ws_client.close()
-            self.ws_client = None
+            self._close_ws_client()
             self.closed = True
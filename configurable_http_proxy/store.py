@@ -1,8 +1,19 @@
+import bisect
+import datetime
+import functools
+import sys
 import typing
 
 from configurable_http_proxy.trie import URLTrie, trim_prefix
 
 
+@functools.lru_cache(maxsize=4096)
+def _clean_path(path: str):
+    # the same paths are cleaned for every request, so memoize them. They are interned, so the route
+    # dicts keyed by them mostly compare keys by identity.
+    return sys.intern(trim_prefix(path))
+
+
 class BaseStore:
     def get_target(self, path):
         raise NotImplementedError(f"{self}: get_target() not implemented")
@@ -23,8 +34,11 @@ class BaseStore:
         path = self.clean_path(path)
         return self.get_all()[path]
 
+    def get_inactive_since(self, inactive_since):
+        return {path: val for path, val in self.get_all().items() if val["last_activity"] < inactive_since}
+
     def clean_path(self, path: str):
-        return trim_prefix(path)
+        return _clean_path(path)
 
 
 class MemoryStore(BaseStore):
@@ -32,30 +46,73 @@ class MemoryStore(BaseStore):
         super().__init__()
         self.routes: typing.Dict[str, URLTrie] = {}
         self.urls = URLTrie()
+        self._serialized_routes = None
+        # (last_activity, path) of all routes with a last_activity, sorted for get_inactive_since()
+        self._by_activity: typing.List[tuple] = []
 
     def get(self, path: str):
         return self.routes.get(self.clean_path(path))
 
     def get_target(self, path: str):
+        # the trie caches the lookups. update() changes the route data in place, which the cached trie
+        # nodes share, so it doesn't have to invalidate them.
         return self.urls.get(path)
 
     def get_all(self):
         return self.routes
 
+    def get_all_serialized(self, dumps):
+        # return dumps(self.get_all()), cached until the routes change
+        if self._serialized_routes is None:
+            self._serialized_routes = dumps(self.routes)
+        return self._serialized_routes
+
+    def get_inactive_since(self, inactive_since):
+        end = bisect.bisect_left(self._by_activity, (inactive_since,))
+        return {path: self.routes[path] for _, path in self._by_activity[:end]}
+
     def add(self, path: str, data):
         path = self.clean_path(path)
+        # the index is updated first, as it is the only step which can fail (e.g. naive and aware
+        # datetimes can't be compared), so that a failed add leaves the store unchanged
+        self._index_activity(_activity_entry(path, data))
+        self._unindex_activity(path)
         self.routes[path] = data
         self.urls.add(path, data)
+        self._serialized_routes = None
 
     def update(self, path: str, data):
-        self.routes[self.clean_path(path)].update(data)
+        path = self.clean_path(path)
+        route = self.routes[path]
+        if "last_activity" in data:
+            self._index_activity(_activity_entry(path, data))
+            self._unindex_activity(path)
+        route.update(data)
+        self._serialized_routes = None
 
     def remove(self, path: str):
         path = self.clean_path(path)
-        if path in self.routes:
-            route = self.routes.get(path)
-            del self.routes[path]
-        else:
-            route = None
+        self._unindex_activity(path)
+        route = self.routes.pop(path, None)
         self.urls.remove(path)
+        self._serialized_routes = None
         return route
+
+    def _index_activity(self, entry):
+        if entry is not None:
+            bisect.insort(self._by_activity, entry)
+
+    def _unindex_activity(self, path: str):
+        entry = _activity_entry(path, self.routes[path]) if path in self.routes else None
+        if entry is not None:
+            i = bisect.bisect_left(self._by_activity, entry)
+            if i < len(self._by_activity) and self._by_activity[i] == entry:
+                del self._by_activity[i]
+
+
+def _activity_entry(path: str, data):
+    # the (last_activity, path) entry of a route in MemoryStore._by_activity, None if it has no datetime
+    last_activity = data.get("last_activity")
+    if isinstance(last_activity, datetime.datetime):
+        return (last_activity, path)
+    return None
@@ -1,90 +1,158 @@
+import functools
 import typing
 
 
 def trim_prefix(prefix):
-    if len(prefix) == 0 or prefix[0] != "/":
+    if not prefix.startswith("/"):
         prefix = "/" + prefix
 
     # ensure path *doesn't* end with / (unless it's exactly /)
-    if len(prefix) > 1 and prefix[-1] == "/":
-        prefix = prefix[:-1]
-
-    return prefix
+    return prefix.rstrip("/") or "/"
 
 
+@functools.lru_cache(maxsize=4096)
 def string_to_path(val):
-    # turn a /prefix/string/ into ['prefix', 'string']
+    # turn a /prefix/string/ into ('prefix', 'string'), a tuple so that the cached result can be shared
     val = val.strip("/")
     if val == "":
         # special case because ''.split() gives [''], which is wrong.
-        return []
+        return ()
     else:
-        return val.split("/")
+        return tuple(val.split("/"))
+
+
+# marks the paths missing from URLTrie._cache, as None is a valid cached result
+_MISSING = object()
 
 
 class URLTrie:
+    # slots make the attribute lookups on the request path cheaper, and the many nodes smaller
+    __slots__ = ("prefix", "branches", "size", "data", "_nodes", "_cache")
+
+    # maximum number of get() results kept, the cache is emptied when it is full
+    cache_size = 4096
+
     def __init__(self, prefix=None):
         self.prefix: str = trim_prefix(prefix or "/")
         self.branches: typing.Dict[str, URLTrie] = {}
         self.size = 0
         self.data = None
+        # the nodes added through this trie, by their path relative to it (e.g. "a/b"), so that get()
+        # probes a single dict per path segment instead of walking down the branches. The branches
+        # created by add() don't keep one.
+        self._nodes: typing.Optional[typing.Dict[str, URLTrie]] = {}
+        # get() results by path, emptied whenever a node is added or removed. The cached nodes are
+        # returned as is, so changes to their data are still visible. Only created by the first get().
+        self._cache: typing.Optional[dict] = None
+
+    @classmethod
+    def _branch(cls, prefix):
+        # a node below the root, created without the root's index
+        node = cls.__new__(cls)
+        node.prefix = trim_prefix(prefix)
+        node.branches = {}
+        node.size = 0
+        node.data = None
+        node._nodes = None
+        node._cache = None
+        return node
 
     def add(self, path, data):
         # add data to a node in the trie at path
         if isinstance(path, str):
             path = string_to_path(path)
-        if len(path) == 0:
-            self.data = data
-            return
-
-        part, *path = path
-        if part not in self.branches:
-            # join with /, and handle the fact that only root ends with '/'
-            prefix = self.prefix if len(self.prefix) == 1 else self.prefix + "/"
-            self.branches[part] = URLTrie(prefix + part)
-            self.size += 1
-        self.branches[part].add(path, data)
+
+        # walk down to the node, creating the missing branches on the way
+        node = self
+        for part in path:
+            child = node.branches.get(part)
+            if child is None:
+                # join with /, and handle the fact that only root ends with '/'
+                prefix = node.prefix if len(node.prefix) == 1 else node.prefix + "/"
+                child = node.branches[part] = URLTrie._branch(prefix + part)
+                node.size += 1
+            node = child
+        node.data = data
+
+        if path and self._nodes is not None:
+            self._nodes["/".join(path)] = node
+        self._cache = None
+        return node
 
     def remove(self, path):
         # remove `path` from the trie
         if isinstance(path, str):
             path = string_to_path(path)
-        if len(path) == 0:
+
+        nodes = [self]
+        for part in path:
+            child = nodes[-1].branches.get(part)
+            if child is None:
+                # Requested node doesn't exist, consider it already removed.
+                break
+            nodes.append(child)
+        else:
             # allow deleting root
-            self.data = None
-            return
-        part, *path = path
-        if part not in self.branches:
-            # Requested node doesn't exist, consider it already removed.
-            return
-        child = self.branches[part]
-        child.remove(path)
-        if child.size == 0 and child.data is None:
-            # child has no branches and is not a leaf
-            del self.branches[part]
-            self.size -= 1
+            nodes[-1].data = None
+
+        # prune the branches left empty along the path, from the bottom up
+        for depth in range(len(nodes) - 2, -1, -1):
+            child = nodes[depth + 1]
+            if child.size == 0 and child.data is None:
+                # child has no branches and is not a leaf
+                del nodes[depth].branches[path[depth]]
+                nodes[depth].size -= 1
+                if self._nodes is not None:
+                    self._nodes.pop("/".join(path[: depth + 1]), None)
+
+        if path and self._nodes is not None:
+            self._nodes.pop("/".join(path), None)
+        self._cache = None
 
     def get(self, path) -> typing.Union[None, "URLTrie"]:
-        # if I have data, return me, otherwise return None
-        me = None if self.data is None else self
+        # return the most specific node with data matching path, or None
+        if not self.branches or not path or path == "/":
+            # nothing below me (e.g. a proxy with only a default route) or the root itself is requested
+            return None if self.data is None else self
+        if self._nodes is None:
+            # a branch, which has no index to probe
+            return self._walk(string_to_path(path) if isinstance(path, str) else path)
+        if not isinstance(path, str):
+            path = "/".join(path)
 
-        if isinstance(path, str):
-            path = string_to_path(path)
+        cache = self._cache
+        if cache is None:
+            cache = self._cache = {}
+        node = cache.get(path, _MISSING)
+        if node is _MISSING:
+            node = self._get(path)
+            if len(cache) >= self.cache_size:
+                cache.clear()
+            # a match of this node itself is cached as True, so that the node doesn't reference itself
+            cache[path] = True if node is self else node
+        return self if node is True else node
 
-        if len(path) == 0:
-            # exact match, it's definitely me!
-            return me
-        part, *path = path
-        if part not in self.branches:
-            # prefix matches, and I don't have any more specific children
-            return me
-        child = self.branches.get(part)
-        # I match and I have a more specific child that matches.
-        # That *does not* mean that I have a more specific *leaf* that matches.
-        node = child.get(path)
-        if node:
-            # found a more specific leaf
-            return node
-        else:
-            # I'm still the most specific match
-            return me
+    def _get(self, path: str) -> typing.Union[None, "URLTrie"]:
+        path = path.strip("/")
+
+        # try the candidate prefixes, from the most specific one (the whole path) to the least
+        while path:
+            node = self._nodes.get(path)
+            if node is not None and node.data is not None:
+                return node
+            path = path.rpartition("/")[0]
+
+        # no more specific node matches, so if I have data, return me, otherwise return None
+        return None if self.data is None else self
+
+    def _walk(self, path) -> typing.Union[None, "URLTrie"]:
+        # the most specific node with data along path, found by walking down the branches
+        found = None if self.data is None else self
+        node = self
+        for part in path:
+            node = node.branches.get(part)
+            if node is None:
+                break
+            if node.data is not None:
+                found = node
+        return found
@@ -44,6 +44,38 @@ class APITestsMixin:
             "target": "http://127.0.0.1:54321",
         }
 
+    def test_target_for_req_after_change(self):
+        assert self.proxy.target_for_req(None, "/path/foo")["prefix"] == "/"
+
+        self.proxy.add_route("/path", {"target": "http://127.0.0.1:12345"})
+        target = self.proxy.target_for_req(None, "/path/foo")
+        assert target == {
+            "prefix": "/path",
+            "target": "http://127.0.0.1:12345",
+        }
+
+        self.proxy.remove_route("/path")
+        assert self.proxy.target_for_req(None, "/path/foo")["prefix"] == "/"
+
+    def test_update_last_activity_is_throttled(self):
+        last_activity = self.proxy.get_route("/")["last_activity"]
+        self.proxy.update_last_activity("/")
+        assert self.proxy.get_route("/")["last_activity"] == last_activity
+
+        last_hour = datetime.datetime.now() - datetime.timedelta(hours=1)
+        self.proxy._routes.update("/", {"last_activity": last_hour})
+        self.proxy.update_last_activity("/")
+        assert self.proxy.get_route("/")["last_activity"] > last_hour
+
+    def test_update_last_activity_is_deferred(self):
+        last_hour = datetime.datetime.now() - datetime.timedelta(hours=1)
+        self.proxy._routes.update("/", {"last_activity": last_hour})
+        self.proxy.update_last_activity("/")
+        assert self.proxy._routes.get("/")["last_activity"] == last_hour
+
+        # reading the routes through the proxy writes the pending activity first
+        assert self.proxy.get_route("/")["last_activity"] > last_hour
+
     def test_without_auth(self):
         resp = self.fetch("/api/routes", with_auth=False, raise_error=False, method="GET")
         assert resp.code == 403
@@ -52,6 +84,18 @@ class APITestsMixin:
         resp = self.fetch("/api/routes", with_auth=False, raise_error=False, method="DELETE")
         assert resp.code == 403
 
+    def test_with_auth_whitespace(self):
+        for auth in ("token\tsecret", "  token   secret  "):
+            resp = self.fetch("/api/routes", with_auth=False, headers={"Authorization": auth})
+            assert resp.code == 200
+
+    def test_with_wrong_auth(self):
+        for auth in ("token wrong", "tokensecret", "bearer secret", "token"):
+            resp = self.fetch(
+                "/api/routes", with_auth=False, raise_error=False, headers={"Authorization": auth}
+            )
+            assert resp.code == 403
+
     def test_get_routes(self):
         resp = self.fetch("/api/routes")
         reply = json.loads(resp.body)
@@ -62,6 +106,18 @@ class APITestsMixin:
             }
         }
 
+    def test_get_routes_after_change(self):
+        resp = self.fetch("/api/routes")
+        assert set(json.loads(resp.body).keys()) == {"/"}
+
+        self.proxy.add_route("/path", {"target": "http://127.0.0.1:12345"})
+        resp = self.fetch("/api/routes")
+        assert set(json.loads(resp.body).keys()) == {"/", "/path"}
+
+        self.proxy.remove_route("/path")
+        resp = self.fetch("/api/routes")
+        assert set(json.loads(resp.body).keys()) == {"/"}
+
     def test_get_single_route(self):
         self.proxy.add_route("/path", {"target": "http://127.0.0.1:12345"})
         resp = self.fetch("/api/routes/path")
@@ -105,6 +161,59 @@ class APITestsMixin:
         assert route["target"] == "http://127.0.0.1:12345"
         assert isinstance(route["last_activity"], datetime.datetime)
 
+    def test_post_create_new_route_with_last_activity(self):
+        # last_activity sent by the client is replaced by the time the route is added
+        body = json.dumps({"target": "http://127.0.0.1:12345", "last_activity": "2020-01-01"})
+        resp = self.fetch("/api/routes/path", method="POST", body=body)
+        assert resp.code == 201
+        route = self.proxy.get_route("/path")
+        assert isinstance(route["last_activity"], datetime.datetime)
+
+        resp = self.fetch("/api/routes")
+        assert "/path" in json.loads(resp.body)
+        inactive_since = (datetime.datetime.now() + datetime.timedelta(hours=1)).isoformat()
+        resp = self.fetch(f"/api/routes?inactive_since={inactive_since}")
+        assert "/path" in json.loads(resp.body)
+
+    def test_post_create_new_route_with_large_numbers(self):
+        body = '{"target": "http://127.0.0.1:12345", "big": 123456789012345678901234567890, "huge": 1e400}'
+        resp = self.fetch("/api/routes/path", method="POST", body=body)
+        assert resp.code == 201
+        route = self.proxy.get_route("/path")
+        assert route["big"] == 123456789012345678901234567890
+        assert route["huge"] == float("inf")
+
+    def test_get_routes_with_non_finite_numbers(self):
+        self.proxy.add_route(
+            "/path", {"target": "http://127.0.0.1:12345", "huge": float("inf"), "none": None}
+        )
+        resp = self.fetch("/api/routes/path")
+        route = json.loads(resp.body)
+        assert route["huge"] == float("inf")
+        assert route["none"] is None
+        resp = self.fetch("/api/routes")
+        assert json.loads(resp.body)["/path"]["huge"] == float("inf")
+
+    def test_get_routes_with_large_integer(self):
+        self.proxy.add_route("/path", {"target": "http://127.0.0.1:12345", "n": 2**70})
+        resp = self.fetch("/api/routes")
+        assert json.loads(resp.body)["/path"]["n"] == 2**70
+        resp = self.fetch("/api/routes/path")
+        assert json.loads(resp.body)["n"] == 2**70
+
+    def test_post_create_new_route_with_bad_data(self):
+        resp = self.fetch("/api/routes/path", method="POST", body="{not json", raise_error=False)
+        assert resp.code == 400
+
+        resp = self.fetch("/api/routes/path", method="POST", body=json.dumps(["target"]), raise_error=False)
+        assert resp.code == 400
+
+        resp = self.fetch(
+            "/api/routes/path", method="POST", body=json.dumps({"target": 1}), raise_error=False
+        )
+        assert resp.code == 400
+        assert self.proxy.get_route("/path") is None
+
     def test_delete_route(self):
         self.proxy.add_route("/path", {"target": "http://127.0.0.1:12345"})
 
@@ -118,6 +227,22 @@ class APITestsMixin:
         route = self.proxy.get_route("/path")
         assert route is None
 
+    def test_delete_route_with_storage_remove_returning_none(self):
+        self.proxy.add_route("/path", {"target": "http://127.0.0.1:12345"})
+        store_remove = self.proxy._routes.remove
+
+        def remove(path):
+            store_remove(path)
+
+        self.proxy._routes.remove = remove
+        resp = self.fetch("/api/routes/path", method="DELETE")
+        assert resp.code == 204
+        assert self.proxy.get_route("/path") is None
+
+    def test_delete_route_not_found(self):
+        resp = self.fetch("/api/routes/path", method="DELETE", raise_error=False)
+        assert resp.code == 404
+
     def test_get_routes_with_inactive_since_invalid(self):
         resp = self.fetch("/api/routes?inactiveSince=endoftheuniverse", raise_error=False)
         assert resp.code == 400
@@ -0,0 +1,55 @@
+import io
+import logging
+import logging.handlers
+import os
+import signal
+import threading
+
+from tornado.ioloop import IOLoop
+
+from configurable_http_proxy import handler, log
+from configurable_http_proxy.cli import _log_in_background, _stop_on_sigterm
+
+
+def test_log_in_background():
+    stream = io.StringIO()
+    previous_stream = handler.setStream(stream)
+    previous_flags = (logging.logThreads, logging.logProcesses, logging.logMultiprocessing)
+    try:
+        stop_logging = _log_in_background()
+        assert handler not in logging.root.handlers
+        assert any(isinstance(h, logging.handlers.QueueHandler) for h in logging.root.handlers)
+
+        log.info("in the background")
+        # stopping writes the records left in the queue, and logs directly again
+        stop_logging()
+        assert "in the background" in stream.getvalue()
+        assert handler in logging.root.handlers
+        assert not any(isinstance(h, logging.handlers.QueueHandler) for h in logging.root.handlers)
+
+        stop_logging()
+        log.info("directly")
+        assert "directly" in stream.getvalue()
+    finally:
+        handler.setStream(previous_stream)
+        logging.logThreads, logging.logProcesses, logging.logMultiprocessing = previous_flags
+
+
+def test_stop_on_sigterm():
+    io_loop = IOLoop()
+    timed_out = []
+
+    def timeout():
+        timed_out.append(True)
+        io_loop.stop()
+
+    try:
+        _stop_on_sigterm(io_loop)
+        # sent while the ioloop is waiting for events
+        threading.Timer(0.1, os.kill, (os.getpid(), signal.SIGTERM)).start()
+        io_loop.call_later(5, timeout)
+        io_loop.start()
+        assert not timed_out
+    finally:
+        io_loop.asyncio_loop.remove_signal_handler(signal.SIGTERM)
+        io_loop.close()
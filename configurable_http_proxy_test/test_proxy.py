@@ -1,17 +1,40 @@
+import asyncio
 import datetime
 import json
 import os
+import socket
 
 import pytest
 from tornado.httpclient import HTTPClientError, HTTPRequest
+from tornado import gen
 from tornado.httpserver import HTTPServer
+from tornado.iostream import IOStream, StreamClosedError
+from tornado.simple_httpclient import HTTPStreamClosedError, SimpleAsyncHTTPClient, _HTTPConnection
 from tornado.testing import AsyncHTTPTestCase, bind_unused_port, get_async_test_timeout, gen_test
 from tornado.web import Application, RequestHandler
 from tornado.websocket import WebSocketHandler, websocket_connect
 
-from configurable_http_proxy.configproxy import PythonProxy
+from configurable_http_proxy.configproxy import _CLOCK_RESOLUTION, PythonProxy
 from configurable_http_proxy_test.testutil import RESOURCES_PATH, pytest_regex
 
+# Values that set-cookie can take:
+# https://developer.mozilla.org/en-US/docs/Web/HTTP/Headers/Set-Cookie
+SET_COOKIE_VALUES = (
+    ("Secure", ""),
+    ("HttpOnly", ""),
+    ("SameSite", "None"),
+    ("Path", "/"),
+    ("Domain", "example.com"),
+    ("Max-Age", "999999"),
+    ("Expires", "Fri, 01 Oct 2020 06:12:16 GMT"),  # .strftime('%a, %d %b %Y %H:%M:%S %Z')
+)
+# Set-Cookie headers sent by TargetHandler with ?with_set_cookie=1
+SET_COOKIE_HEADERS = (
+    "key=val",
+    *(f"{name}_key=val; {name}={val}" for name, val in SET_COOKIE_VALUES),
+    "combined_key=val; " + "; ".join(f"{name}={val}" for name, val in SET_COOKIE_VALUES),
+)
+
 
 class TargetHandler(WebSocketHandler):
     def initialize(self, target=None, path=None, **kwargs):
@@ -28,28 +51,16 @@ class TargetHandler(WebSocketHandler):
             "target": self.target,
             "path": self.path,
             "url": self.request.uri,
-            "headers": dict(self.request.headers.get_all()),
         }
+        if self.get_argument("include_headers", None):
+            reply["headers"] = dict(self.request.headers.get_all())
         self.set_status(200)
         self.set_header("Content-Type", "application/json")
         if self.get_argument("with_set_cookie", None):
-            # Values that set-cookie can take:
-            # https://developer.mozilla.org/en-US/docs/Web/HTTP/Headers/Set-Cookie
-            values = {
-                "Secure": "",
-                "HttpOnly": "",
-                "SameSite": "None",
-                "Path": "/",
-                "Domain": "example.com",
-                "Max-Age": "999999",
-                "Expires": "Fri, 01 Oct 2020 06:12:16 GMT",  # .strftime('%a, %d %b %Y %H:%M:%S %Z')
-            }
-            self.add_header("Set-Cookie", "key=val")
-            for name, val in values.items():
-                self.add_header("Set-Cookie", f"{name}_key=val; {name}={val}")
-            combined = "; ".join((f"{name}={val}" for name, val in values.items()))
-            self.add_header("Set-Cookie", f"combined_key=val; {combined}")
+            for cookie in SET_COOKIE_HEADERS:
+                self.add_header("Set-Cookie", cookie)
 
+        # bytes, written as is
         self.write(json.dumps(reply))
         self.finish()
 
@@ -65,6 +76,15 @@ class TargetHandler(WebSocketHandler):
         self.write_message(json.dumps(reply))
 
 
+class RecordingTargetHandler(TargetHandler):
+    def initialize(self, received=None, **kwargs):
+        super().initialize(**kwargs)
+        self.received = received
+
+    def on_message(self, message):
+        self.received.append(message)
+
+
 class RedirectingTargetHandler(RequestHandler):
     def initialize(self, target=None, path=None, redirect_to=None, **kwargs):
         super().initialize(**kwargs)
@@ -88,6 +108,51 @@ class ErrorTargetHandler(RequestHandler):
         self.finish()
 
 
+class NoEtagTargetHandler(RequestHandler):
+    def initialize(self, target=None, path=None, **kwargs):
+        super().initialize(**kwargs)
+
+    def compute_etag(self):
+        return None
+
+    def get(self, path=None):
+        self.set_header("Content-Type", "text/plain")
+        self.write("no etag")
+        self.finish()
+
+
+class LargeTargetHandler(RequestHandler):
+    def initialize(self, target=None, path=None, **kwargs):
+        super().initialize(**kwargs)
+
+    async def get(self, path=None):
+        self.write(b"x" * int(self.get_query_argument("size")))
+        if self.get_query_argument("fail", None):
+            # send part of the response and drop the connection
+            await self.flush()
+            self.request.connection.close()
+            return
+        self.finish()
+
+
+class StreamingTargetHandler(RequestHandler):
+    def initialize(self, target=None, path=None, sent=None, **kwargs):
+        super().initialize(**kwargs)
+        self.sent = sent
+
+    async def get(self, path=None):
+        # send the response in 64KB chunks, counting those the proxy has accepted
+        for _ in range(int(self.get_query_argument("chunks"))):
+            self.write(b"x" * 65536)
+            try:
+                await self.flush()
+            except StreamClosedError:
+                # the proxy stopped reading the response
+                return
+            self.sent.append(1)
+        self.finish()
+
+
 class TestProxy(AsyncHTTPTestCase):
     def _add_server(self, server):
         servers = getattr(self, "_created_http_servers", [])
@@ -117,7 +182,12 @@ class TestProxy(AsyncHTTPTestCase):
     def tearDown(self):
         for server in self._created_http_servers:
             server.stop()
-            self.io_loop.run_sync(server.close_all_connections, timeout=get_async_test_timeout())
+
+        async def close_all_connections():
+            await asyncio.gather(*(server.close_all_connections() for server in self._created_http_servers))
+
+        self.io_loop.run_sync(close_all_connections, timeout=get_async_test_timeout())
+        self.proxy.close()
         return super().tearDown()
 
     def get_app(self):
@@ -140,8 +210,9 @@ class TestProxy(AsyncHTTPTestCase):
         assert reply["path"] == "/"
 
         # check last_activity was updated
+        # the timestamps have a resolution of _CLOCK_RESOLUTION
         route = self.proxy.get_route("/")
-        assert route["last_activity"] > now
+        assert route["last_activity"] > now - datetime.timedelta(seconds=_CLOCK_RESOLUTION)
 
         # check the other HTTP methods too
         resp = self.fetch("/", method="HEAD", raise_error=False)
@@ -161,7 +232,8 @@ class TestProxy(AsyncHTTPTestCase):
     def test_basic_websocket_request(self):
         now = datetime.datetime.now()
         route = self.proxy.get_route("/")
-        assert route["last_activity"] <= now
+        last_activity = route["last_activity"]
+        assert last_activity <= now
 
         ws_client = yield websocket_connect(self.get_url("/").replace("http:", "ws:"))
 
@@ -176,14 +248,74 @@ class TestProxy(AsyncHTTPTestCase):
 
         # check last_activity was updated
         route = self.proxy.get_route("/")
-        assert route["last_activity"] > now
+        assert route["last_activity"] > now - datetime.timedelta(seconds=_CLOCK_RESOLUTION)
+
+    @gen_test
+    def test_websocket_request_message_burst(self):
+        ws_client = yield websocket_connect(self.get_url("/").replace("http:", "ws:"))
+        response = yield ws_client.read_message()
+        assert response == "connected"
+
+        for delay in (0, 0.005):
+            self.proxy.ws_batch_delay = delay
+            messages = [f"message {i} with delay {delay}" for i in range(10)]
+            for message in messages:
+                ws_client.write_message(message)
+
+            for message in messages:
+                response = yield ws_client.read_message()
+                reply = json.loads(response)
+                assert reply["message"] == message
+
+    @gen_test
+    async def test_websocket_messages_sent_before_close(self):
+        for delay in (0, 0.05):
+            received = []
+            path = f"/recording/{delay}"
+            self._add_target_route(path, handler=RecordingTargetHandler, received=received)
+            self.proxy.ws_batch_delay = delay
+
+            ws_client = await websocket_connect(self.get_url(path).replace("http:", "ws:"))
+            assert await ws_client.read_message() == "connected"
+            messages = [f"m{i}" for i in range(5)]
+            for message in messages:
+                ws_client.write_message(message)
+            ws_client.close()
+
+            # all the messages reach the target, even though the client closed right away
+            for _ in range(100):
+                if len(received) == len(messages):
+                    break
+                await gen.sleep(0.01)
+            assert received == messages
 
     def test_sending_headers(self):
-        resp = self.fetch("/", headers={"testing": "OK"})
+        resp = self.fetch("/?include_headers=1", headers={"testing": "OK"})
         reply = json.loads(resp.body)
         assert reply["path"] == "/"
         assert reply["headers"].get("Testing") == "OK"
 
+    def test_x_forward_headers(self):
+        resp = self.fetch("/?include_headers=1")
+        reply = json.loads(resp.body)
+        assert reply["headers"]["X-Forwarded-For"] == "127.0.0.1"
+        assert reply["headers"]["X-Forwarded-Port"] == str(self.get_http_port())
+        assert reply["headers"]["X-Forwarded-Proto"] == "http"
+        assert reply["headers"]["X-Forwarded-Host"] == f"127.0.0.1:{self.get_http_port()}"
+
+        resp = self.fetch(
+            "/?include_headers=1", headers={"X-Forwarded-For": "10.0.0.1", "X-Forwarded-Host": "example.com"}
+        )
+        reply = json.loads(resp.body)
+        assert reply["headers"]["X-Forwarded-For"] == "10.0.0.1,127.0.0.1"
+        assert reply["headers"]["X-Forwarded-Host"] == "example.com"
+
+    def test_without_x_forward_headers(self):
+        self.proxy.x_forward = False
+        resp = self.fetch("/?include_headers=1")
+        reply = json.loads(resp.body)
+        assert "X-Forwarded-For" not in reply["headers"]
+
     def test_proxy_request_event_can_modify_header(self):
         pytest.skip("proxy_request event is not supported")
 
@@ -279,6 +411,10 @@ class TestProxy(AsyncHTTPTestCase):
         proxy = PythonProxy({"storage_backend": PlugableDummyStore})
         assert type(proxy._routes).__name__ == "PlugableDummyStore"
 
+    def test_storage_backend_config_alias(self):
+        proxy = PythonProxy({"storage_backend": "memory"})
+        assert type(proxy._routes).__name__ == "MemoryStore"
+
     def test_without_include_prefix_and_without_prepend_path(self):
         self.proxy.include_prefix = False
         self.proxy.prepend_path = False
@@ -369,6 +505,80 @@ class TestProxy(AsyncHTTPTestCase):
         assert "text/html" in resp.headers["content-type"]
         assert b"<title>503: Service Unavailable</title>" in resp.body
 
+    def test_response_without_etag(self):
+        self._add_target_route("/noetag", handler=NoEtagTargetHandler)
+        resp = self.fetch("/noetag")
+        assert resp.body == b"no etag"
+        assert resp.headers["Content-Length"] == "7"
+        assert "Etag" not in resp.headers
+
+    def test_large_response_is_streamed(self):
+        self._add_target_route("/large", handler=LargeTargetHandler)
+        resp = self.fetch("/large?size=1000000")
+        assert resp.body == b"x" * 1000000
+        assert "Content-Length" not in resp.headers
+
+    def test_large_response_failure(self):
+        self._add_target_route("/large", handler=LargeTargetHandler)
+        # the client must not see the partial response as a complete one
+        with pytest.raises(HTTPStreamClosedError):
+            self.fetch("/large?size=1000000&fail=1")
+
+    @gen_test
+    async def test_large_response_to_slow_client(self):
+        sent = []
+        self._add_target_route("/stream", handler=StreamingTargetHandler, sent=sent)
+        chunks = 512  # 32MB
+
+        sock = socket.socket()
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 65536)
+        stream = IOStream(sock)
+        await stream.connect(("127.0.0.1", self.get_http_port()))
+        request = f"GET /stream?chunks={chunks} HTTP/1.1\r\nHost: 127.0.0.1\r\nConnection: close\r\n\r\n"
+        await stream.write(request.encode())
+        headers = await stream.read_until(b"\r\n\r\n")
+        assert headers.startswith(b"HTTP/1.1 200")
+
+        # while the client doesn't read, the proxy stops reading from the target too
+        await gen.sleep(0.5)
+        assert len(sent) < chunks // 2
+
+        body = await stream.read_until_close()
+        assert body.count(b"x") == chunks * 65536
+        assert len(sent) == chunks
+
+    def test_streaming_http_client_internals(self):
+        # the backpressure on streamed responses relies on these tornado internals
+        http_client = self.proxy.http_client
+        assert isinstance(http_client, SimpleAsyncHTTPClient)
+        connection_class = http_client._connection_class()
+        assert issubclass(connection_class, _HTTPConnection)
+        assert connection_class.data_received is not _HTTPConnection.data_received
+        assert callable(getattr(_HTTPConnection, "_should_follow_redirect", None))
+
+    def test_close(self):
+        http_client = self.proxy.http_client
+        self.proxy.close()
+        assert http_client._closed
+        # a new client is created if the proxy is used again
+        assert self.proxy.http_client is not http_client
+
+    @gen_test
+    async def test_large_response_to_closed_client(self):
+        sent = []
+        self._add_target_route("/stream", handler=StreamingTargetHandler, sent=sent)
+        chunks = 512
+
+        stream = IOStream(socket.socket())
+        await stream.connect(("127.0.0.1", self.get_http_port()))
+        await stream.write(f"GET /stream?chunks={chunks} HTTP/1.1\r\nHost: 127.0.0.1\r\n\r\n".encode())
+        await stream.read_until(b"\r\n\r\n")
+        stream.close()
+
+        # the proxy stops reading from the target once the client is gone
+        await gen.sleep(0.5)
+        assert len(sent) < chunks
+
     def test_redirect_location_untouched_without_rewrite_option(self):
         redirect_to = "http://foo.com:12345/whatever"
         self._add_target_route(
@@ -454,7 +664,7 @@ class TestProxy(AsyncHTTPTestCase):
 
     def test_custom_headers(self):
         self.proxy.custom_headers = {"testing_from_custom": "OK"}
-        resp = self.fetch("/", headers={"testing_from_request": "OK"})
+        resp = self.fetch("/?include_headers=1", headers={"testing_from_request": "OK"})
         reply = json.loads(resp.body)
         assert reply["path"] == "/"
         assert reply["headers"].get("Testing_from_request") == "OK"
@@ -462,7 +672,7 @@ class TestProxy(AsyncHTTPTestCase):
 
     def test_custom_headers_higher_priority(self):
         self.proxy.custom_headers = {"testing": "from_custom"}
-        resp = self.fetch("/", headers={"testing": "from_request"})
+        resp = self.fetch("/?include_headers=1", headers={"testing": "from_request"})
         reply = json.loads(resp.body)
         assert reply["path"] == "/"
         assert reply["headers"].get("Testing") == "from_custom"
@@ -470,13 +680,7 @@ class TestProxy(AsyncHTTPTestCase):
     def test_receiving_headers_setcookie(self):
         # When the same header has multiple values - it needs to be handled correctly.
         resp = self.fetch("/?with_set_cookie=1")
-        headers = list(resp.headers.get_all())
-        cookies = {}
-        for header_name, header in headers:
-            if header_name.lower() != "set-cookie":
-                continue
-            key, val = header.split("=", 1)
-            cookies[key] = val
+        cookies = dict(header.split("=", 1) for header in resp.headers.get_list("Set-Cookie"))
         assert "key" in cookies
         assert cookies["key"] == "val"
         assert "combined_key" in cookies
@@ -1,5 +1,8 @@
+import datetime
 import os
 
+import pytest
+
 from configurable_http_proxy.dbstore import DatabaseStore
 from configurable_http_proxy.store import MemoryStore
 
@@ -25,6 +28,18 @@ class StoreTestsMixin:
         assert target.prefix == "/myRoute"
         assert target.data["target"] == "http://localhost:8213"
 
+    def test_get_target_after_change(self):
+        self.subject.add("/", {"target": "http://localhost:8213"})
+        assert self.subject.get_target("/myRoute").prefix == "/"
+
+        self.subject.add("/myRoute", {"target": "http://localhost:8214"})
+        target = self.subject.get_target("/myRoute")
+        assert target.prefix == "/myRoute"
+        assert target.data["target"] == "http://localhost:8214"
+
+        self.subject.remove("/myRoute")
+        assert self.subject.get_target("/myRoute").prefix == "/"
+
     def test_get_all(self):
         self.subject.add("/myRoute", {"test": "value1"})
         self.subject.add("/myOtherRoute", {"test": "value2"})
@@ -38,6 +53,29 @@ class StoreTestsMixin:
         routes = self.subject.get_all()
         assert routes == {}
 
+    def test_get_inactive_since(self):
+        now = datetime.datetime.now()
+        self.subject.add("/today", {"last_activity": now})
+        self.subject.add("/yesterday", {"last_activity": now - datetime.timedelta(days=1)})
+
+        assert self.subject.get_inactive_since(now - datetime.timedelta(days=2)) == {}
+        routes = self.subject.get_inactive_since(now - datetime.timedelta(hours=1))
+        assert set(routes.keys()) == {"/yesterday"}
+        routes = self.subject.get_inactive_since(now + datetime.timedelta(hours=1))
+        assert set(routes.keys()) == {"/today", "/yesterday"}
+
+    def test_get_inactive_since_after_update(self):
+        now = datetime.datetime.now()
+        self.subject.add("/myRoute", {"last_activity": now - datetime.timedelta(days=1)})
+        self.subject.add("/myOtherRoute", {"last_activity": now - datetime.timedelta(days=1)})
+        assert set(self.subject.get_inactive_since(now).keys()) == {"/myRoute", "/myOtherRoute"}
+
+        self.subject.update("/myRoute", {"last_activity": now})
+        assert set(self.subject.get_inactive_since(now).keys()) == {"/myOtherRoute"}
+
+        self.subject.remove("/myOtherRoute")
+        assert self.subject.get_inactive_since(now) == {}
+
     def test_add(self):
         self.subject.add("/myRoute", {"test": "value"})
 
@@ -59,6 +97,14 @@ class StoreTestsMixin:
         assert route["version"] == 2
         assert route["test"] == "value"
 
+    def test_update_with_datetime(self):
+        now = datetime.datetime.now()
+        self.subject.add("/myRoute", {"test": "value", "nested": {"key": "value"}})
+        self.subject.update("/myRoute", {"last_activity": now})
+
+        route = self.subject.get("/myRoute")
+        assert route == {"test": "value", "nested": {"key": "value"}, "last_activity": now}
+
     def test_remove(self):
         self.subject.add("/myRoute", {"test": "value"})
         self.subject.remove("/myRoute")
@@ -84,9 +130,34 @@ class TestMemoryStore(StoreTestsMixin):
     def setup_method(self, method):
         self.subject = MemoryStore()
 
+    def test_failed_update_leaves_store_unchanged(self):
+        now = datetime.datetime.now()
+        self.subject.add("/myRoute", {"test": "value", "last_activity": now})
+        aware = datetime.datetime.now(datetime.timezone.utc)
+        with pytest.raises(TypeError):
+            self.subject.update("/myRoute", {"last_activity": aware})
+        with pytest.raises(TypeError):
+            self.subject.add("/myOtherRoute", {"test": "value", "last_activity": aware})
+        assert self.subject.get("/myRoute")["last_activity"] == now
+        assert self.subject.get("/myOtherRoute") is None
+        assert self.subject.get_target("/myOtherRoute") is None
+        assert list(self.subject.get_inactive_since(now + datetime.timedelta(hours=1))) == ["/myRoute"]
+
 
 class TestDataBaseStore(StoreTestsMixin):
     def setup_method(self, method):
         os.environ["CHP_DATABASE_URL"] = "sqlite:///chp_test.sqlite"
         self.subject = DatabaseStore()
         self.subject.clean()
+
+    def test_update_last_activity_keeps_target_cache(self):
+        self.subject.add("/myRoute", {"test": "value"})
+        assert self.subject.get_target("/myRoute/path").prefix == "/myRoute"
+        assert self.subject._target_cache
+
+        self.subject.update("/myRoute", {"last_activity": datetime.datetime.now()})
+        assert self.subject._target_cache
+
+        self.subject.update("/myRoute", {"test": "other"})
+        assert not self.subject._target_cache
+        assert self.subject.get_target("/myRoute/path").data["test"] == "other"
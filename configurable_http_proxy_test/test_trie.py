@@ -39,6 +39,8 @@ class TestUrlTrie:
         node = trie.get("")
         assert node.prefix == "/"
         assert node.data == -1
+        # with only a root route, lookups don't need the cache
+        assert not trie._cache
 
     def test_add(self):
         trie = URLTrie()
@@ -178,3 +180,49 @@ class TestUrlTrie:
 
         node = trie.get("/prefix/sub")
         assert node.prefix == "/"
+
+    def test_get_cache(self):
+        trie = setup_full_trie()
+        assert trie.get("/b/c/dword").prefix == "/b/c"
+        assert trie.get("/b/c/dword").prefix == "/b/c"
+        assert list(trie._cache) == ["/b/c/dword"]
+
+        trie.remove("/b/c")
+        assert not trie._cache
+        assert trie.get("/b/c/dword").prefix == "/b"
+
+        trie.add("/b/c/dword", {"path": "/b/c/dword"})
+        assert trie.get("/b/c/dword").prefix == "/b/c/dword"
+
+        # the root is returned without going through the cache
+        trie.add("/", {"path": "/"})
+        assert trie.get("/").prefix == "/"
+        assert trie.get("").prefix == "/"
+        assert not trie._cache
+
+        # matches of the root itself are cached without referencing the root
+        assert trie.get("/not/found") is trie
+        assert trie.get("/not/found") is trie
+        assert trie._cache == {"/not/found": True}
+
+    def test_get_cache_size(self, monkeypatch):
+        monkeypatch.setattr(URLTrie, "cache_size", 2)
+        trie = setup_full_trie()
+        for path in ("/1/x", "/2/x", "/b/x"):
+            trie.get(path)
+        assert len(trie._cache) == 1
+        assert trie.get("/1/x").prefix == "/1"
+
+    def test_index(self):
+        trie = setup_full_trie()
+        # only the root indexes the nodes, by their path relative to it
+        assert set(trie._nodes) == {"1", "2", "a/b/c/d", "a/b/d", "a/b/e", "b", "b/c", "b/c/d"}
+        assert trie.branches["b"]._nodes is None
+
+        trie.remove("/b/c")
+        trie.remove("/a/b/c/d")
+        assert set(trie._nodes) == {"1", "2", "a/b/d", "a/b/e", "b", "b/c/d"}
+
+        # branches are searched by walking down from them
+        node = trie.branches["b"].get("/c/d/word")
+        assert node.prefix == "/b/c/d"
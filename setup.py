@@ -1,9 +1,15 @@
 import os
 
-from setuptools import find_packages, setup
+from setuptools import setup
 
 BASE_PATH = os.path.abspath(os.path.dirname(__file__))
 
+
+def read_file(*path):
+    with open(os.path.join(BASE_PATH, *path)) as fh:
+        return fh.read()
+
+
 if __name__ == "__main__":
     setup(
         name="configurable-http-proxy",
@@ -12,20 +18,21 @@ if __name__ == "__main__":
         author_email="postmaster@corridorplatforms.com",
         license="Apache License 2.0",
         description="A python implementation of configurable-http-proxy",
-        long_description=open(os.path.join(BASE_PATH, "README.md")).read(),
+        long_description=read_file("README.md"),
         long_description_content_type="text/markdown",
         use_scm_version={
             "write_to": "configurable_http_proxy/version.txt",
         },
         setup_requires=["setuptools_scm"],
-        install_requires=open(os.path.join(BASE_PATH, "requirements", "base.txt")).readlines(),
+        install_requires=read_file("requirements", "base.txt").splitlines(),
         extras_require={
             "sql": ["dataset"],
+            "orjson": ["orjson"],
         },
         python_requires=">=3.6",
         include_package_data=True,
         zip_safe=False,
-        packages=find_packages(include=["configurable_http_proxy", "configurable_http_proxy.*"]),
+        packages=["configurable_http_proxy"],
         entry_points={
             "console_scripts": [
                 "configurable-http-proxy = configurable_http_proxy.cli:main",